@@ -8,13 +8,61 @@ import multiprocessing
 import logging
 import traceback
 import base64
+import os
+import threading
+import itertools
+from collections import OrderedDict
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from pyclickhouse.Cursor import Cursor
 
 
+# Sessions (and thus TCP connection pools) shared by all Connections with the same target and pool parameters.
+# The process id is part of the key, so that a forked process never reuses sockets of its parent.
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def _build_adapters(pool_connections, pool_maxsize):
+    """
+    Return a new adapters mapping for a session, ordered by descending prefix length like Session.mount keeps it.
+    """
+    # The pool doesn't block when exhausted: requests waits for a pooled connection without any timeout, which would
+    # hang forever e.g. while another cursor holds the only connection with a partially read select_stream.
+    # Connection errors are retried with backoff. Read errors are not retried, as for max_retries=3 before, because
+    # the query might have been executed already.
+    adapters = OrderedDict()
+    for prefix in ['https://', 'http://']:
+        adapters[prefix] = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                       max_retries=Retry(total=3, read=False, backoff_factor=0.1))
+    return adapters
+
+
+def _get_session(key, renew=False):
+    """
+    Return the shared session for the key, which is (pid, host, port, pool_connections, pool_maxsize). If renew is
+    True, the connection pools of the existing session are closed and replaced by new ones. The session object itself
+    stays the same, so that all Connections using it keep sharing it.
+    """
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = requests.Session()
+            session.adapters = _build_adapters(key[3], key[4])
+            _SESSIONS[key] = session
+        elif renew:
+            # Other threads may be sending requests with the session right now, so its adapters mapping is replaced
+            # in one assignment instead of being changed in place, and only the old adapters are closed afterwards.
+            old_adapters = session.adapters
+            session.adapters = _build_adapters(key[3], key[4])
+            for adapter in old_adapters.values():
+                adapter.close()
+        return session
+
+
 class Connection(object):
     """
     Represents a Connection to Clickhouse. Because HTTP protocol is used underneath, no real Connection is
@@ -23,11 +71,10 @@ class Connection(object):
     Clickhouse does not support transactions, thus there is no commit method. Inserts are commited automatically
     if they don't produce errors.
     """
-    Session=None
-    Pool_connections=1
-    Pool_maxsize=10
+    __slots__ = ('host', 'port', 'username', 'password', 'state', 'timeout', 'auth_method', 'clickhouse_settings_encoded',
+                 'session', '_session_key', '_base_url', '_url', '_headers')
 
-    def __init__(self, host, port=None, username='default', password='', pool_connections=1, pool_maxsize=10, timeout=5, clickhouse_settings='', auth_method=None):
+    def __init__(self, host, port=None, username='default', password='', pool_connections=1, pool_maxsize=10, timeout=5, clickhouse_settings='', auth_method=None, http_compression=True):
         """
         Create a new Connection object. Because HTTP protocol is used underneath, no real Connection is
         created. The Connection is rather an temporary object to create cursors.
@@ -45,6 +92,8 @@ class Connection(object):
         :param pool_connections: optional number of TCP connections to pre-create when the Connection object is created.
         :param pool_maxsize: optional maximum number of TCP-connections this Connection object may make to the Clickhouse host.
         :param auth_method: 'legacy' for the Authorization header, 'x' for the X-ClickHouse-User
+        :param http_compression: optional, whether Clickhouse should compress responses (requests decompresses them
+        transparently). The default value is True.
         :return: the Connection object
         """
         tmp = host.split(':')
@@ -65,57 +114,50 @@ class Connection(object):
         self.clickhouse_settings_encoded = ''
         if len(clickhouse_settings) > 0:
             self.clickhouse_settings_encoded = '&' + '&'.join(['%s=%s' % pair for pair in list(clickhouse_settings.items())])
+        if http_compression and 'enable_http_compression' not in clickhouse_settings:
+            # requests already sends Accept-Encoding: gzip, deflate, but Clickhouse compresses only if enabled
+            self.clickhouse_settings_encoded += '&enable_http_compression=1'
+
+        # URL and credential headers never change for a Connection, so they are built only once here and not in _call
+        self._base_url = 'http://%s:%s' % (self.host, self.port)
+        self._url = '%s?%s' % (self._base_url, self.clickhouse_settings_encoded)
+        credentials = self.username + ':' + self.password
+        if self.auth_method == 'legacy':
+            self._headers = {'Authorization': 'Basic %s' % (base64.b64encode(credentials.encode('ISO-8859-1')).decode('ascii'),)}
+        elif self.auth_method == 'x':
+            self._headers = {'X-ClickHouse-User': self.username, 'X-ClickHouse-Key': self.password}
+        else:
+            self._headers = {}
+
+        self._session_key = (os.getpid(), self.host, self.port, pool_connections, pool_maxsize)
+        self.session = _get_session(self._session_key)
+
+    def reopensession(self):
+        """
+        Replace the TCP connection pool used by this Connection (and all other Connections sharing it) with a new one.
+        """
+        _get_session(self._session_key, renew=True)
 
-        if Connection.Session is None or pool_connections != Connection.Pool_connections or pool_maxsize != Connection.Pool_maxsize:
-            Connection.reopensession(pool_connections, pool_maxsize)
-
-    @staticmethod
-    def reopensession(pool_connections=1, pool_maxsize=10):
-        if Connection.Session is not None:
-            Connection.Session.close()
-        Connection.Session = requests.Session()
-        Connection.Session.mount('http://', HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=3))
-        Connection.Session.mount('https://', HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=3))
-        Connection.Pool_connections = pool_connections
-        Connection.Pool_maxsize = pool_maxsize
-
-    def _call(self, query = None, payload = None):
+    def _call(self, query = None, payload = None, stream = False):
         """
-        Private method, use Cursor to make calls to Clickhouse.
+        Private method, use Cursor to make calls to Clickhouse. If stream is True, the response body is not
+        downloaded until it is consumed (e.g. using iter_content).
         """
         try:
-            credentials = self.username + ':' + self.password
-            if self.auth_method == 'legacy':
-                header = {'Authorization': 'Basic %s' % (base64.b64encode(credentials.encode('ISO-8859-1')),)}
-            elif self.auth_method == 'x':
-                header = {'X-ClickHouse-User': self.username, 'X-ClickHouse-Key': self.password}
-            else:
-                header = {}
-
             if query is None:
-                return Connection.Session.get('http://%s:%s' % (self.host, self.port), timeout=self.timeout, headers=header)
+                return self.session.get(self._base_url, timeout=self.timeout, headers=self._headers)
 
             if payload is None:
-                url = 'http://%s:%s?%s' % \
-                                    (
-                                        self.host,
-                                        str(self.port),
-                                        self.clickhouse_settings_encoded
-                                    )
                 if isinstance(query, str):
                     query = query.encode('utf8')
-                r = Connection.Session.post(url, query, timeout=self.timeout, headers=header)
+                r = self.session.post(self._url, query, timeout=self.timeout, headers=self._headers, stream=stream)
             else:
-                url = 'http://%s:%s?%s' % \
-                                    (
-                                        self.host,
-                                        str(self.port),
-                                        self.clickhouse_settings_encoded
-                                    )
-                if isinstance(payload, str):
-                    payload = payload.encode('utf8')
-                payload = query.encode('utf-8') + '\n'.encode() + payload  # on python 3, all parts must be encoded (no implicit conversion)
-                r = Connection.Session.post(url, payload, timeout=self.timeout, headers=header)
+                # The payload is either bytes-like or an iterable of bytes chunks. It is sent after the query line
+                # using chunked transfer encoding, so that it doesn't have to be copied to prepend the query.
+                if isinstance(payload, (bytes, bytearray, memoryview)):
+                    payload = [payload]
+                payload = itertools.chain([query.encode('utf-8') + b'\n'], payload)
+                r = self.session.post(self._url, payload, timeout=self.timeout, headers=self._headers, stream=stream)
             if not r.ok:
                 raise Exception('Query %s raised error %s' % (query, r.content))
             return r
@@ -123,7 +165,7 @@ class Connection(object):
             self.close()
             try:
                 if 'BadStatusLine' in str(e):  # e.g. ConnectionError has no attr. message
-                    Connection.reopensession()
+                    self.reopensession()
             except:
                 pass
             logging.error(traceback.format_exc())
@@ -142,19 +184,19 @@ class Connection(object):
 
     def close(self):
         """
-        Closes the TCP connection pool and sets the state to 'closed'. Note that you cannot reuse this Connection object
-         after calling this method.
+        Sets the state to 'closed'. The TCP connection pool is shared with other Connections to the same host and
+        is therefore kept open.
         """
         self.state = 'closed'
-        Connection.Session.close()
 
 
-    def cursor(self):
+    def cursor(self, result_cache_size=0):
         """
+        :param result_cache_size: optional number of select results the Cursor keeps in its cache, see Cursor
         :return: a Cursor
         """
         self.open()
-        return Cursor(self)
+        return Cursor(self, result_cache_size)
 
 
 
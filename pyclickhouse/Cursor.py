@@ -5,11 +5,80 @@ import logging
 import time
 import re
 import ujson
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:  # python 2
+    from collections import Mapping
+try:
+    import orjson  # optional, considerably faster than ujson
+except ImportError:
+    orjson = None
+else:
+    _ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS |
+                       orjson.OPT_PASSTHROUGH_SUBCLASS)
 
 from pyclickhouse.FilterableCache import FilterableCache
 from pyclickhouse.formatter import TabSeparatedWithNamesAndTypesFormatter, NestingLevelTooHigh
 
 
+_FORMAT_RE = re.compile(r'\s+format\s+\w+\s*$', re.IGNORECASE)
+# Types checked with isinstance when flattening documents, which is much cheaper than probing with hasattr
+_ARRAY_TYPES = (list, tuple, set, frozenset)
+_STRING_TYPES = (type(u''), type(b''))
+# Exact types of values known not to be iterable, so that probing them with hasattr can be skipped
+_SCALAR_TYPES = frozenset([int, float, bool, type(u''), type(b''), dt.date, dt.datetime])
+
+
+def _isotheriterable(value):
+    """
+    Whether the value is an iterable other than the array and string types, e.g. a generator or a map object.
+    """
+    return type(value) not in _SCALAR_TYPES and not isinstance(value, _STRING_TYPES) and hasattr(value, '__iter__')
+
+
+def _escapestring(param):
+    return "'%s'" % (str(param).replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _escapedatetime(param):
+    return "'%s'" % (str(param.replace(microsecond=0)))
+
+
+# Escaping functions of query parameters by their exact type, which is cheaper than testing them with isinstance
+_ESCAPERS = {
+    bool: lambda param: '1' if param else '0',
+    int: str,
+    float: str,
+    dt.datetime: _escapedatetime,
+    str: _escapestring,
+}
+
+
+def _isconcurrentschemachange(e):
+    """
+    Whether the exception is caused by another client changing the same table at the same time, so that retrying
+    with the refreshed schema can succeed.
+    """
+    message = str(e)
+    return 'bad version' in message or 'already exists' in message
+
+
+def _tojson(value):
+    """
+    Serialize the value to JSON using orjson if it is installed, otherwise using ujson. The JSON text of both encodes
+    the same values, but its style differs: orjson doesn't escape "/" and non-ASCII characters, writes floats like
+    1e20 instead of 1e+20, and writes NaN and Infinity as null. ujson is also used for the values orjson can't
+    serialize at all, like integers exceeding 64 bit. Values ujson rejects, like datetimes, are rejected by both.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, option=_ORJSON_OPTIONS).decode('utf8')
+        except TypeError:  # e.g. integers exceeding 64 bit, which ujson can handle
+            pass
+    return ujson.dumps(value)
+
+
 class Cursor(object):
     """
     Due to special design of Clickhouse, this Cursor object has a little different set of methods compared to
@@ -25,35 +94,56 @@ class Cursor(object):
         "ddl" for any other statemets that don't deliver result,
         "insert" for inserting a single row (not recommended by Clickhouse)
 
-    When calling "select", you can only use FORMAT TabSeparatedWithNamesAndTypes in your query, or omit it, in
-    which case it will be added to the query automatically.
+    When calling "select", you can only use the FORMAT of the Cursor's "formatter" in your query (its "output_format",
+    TabSeparatedWithNamesAndTypes by default), or omit it, in which case it will be added to the query automatically.
+    Set "formatter" to a RowBinaryWithNamesAndTypesFormatter for faster parsing of large results; note that it
+    returns DateTime values in UTC instead of the time zone of the server.
 
     After calling "select", you can call "fetchone" or "fetchall" to retrieve results, which will come in form
-    of dictionaries.
+    of dictionaries. For large results, call "select_stream" instead, to parse the rows only while they are fetched.
 
     You can pass parameters to the queries, by marking their places in the query using %s, for example
     cursor.select('SELECT count() FROM table WHERE field=%s', 123)
+
+    If the Cursor is created with a result_cache_size > 0, results of "select" are kept in a LRU cache keyed by the
+    query and its parameters, so that repeating a select doesn't go to Clickhouse again. The cache is cleared by every
+    "ddl", "insert" or "bulkinsert" made with this Cursor, but not by changes made by other clients, so only use it if
+    slightly outdated results are acceptable.
     """
-    def __init__(self, connection):
+    def __init__(self, connection, result_cache_size=0):
         """
         Create new Cursor object.
         """
         self.connection = connection
+        self.resultcachesize = result_cache_size
+        self.resultcache = OrderedDict()
         self.lastresult = None
         self.lastparsedresult = None
         self.formatter = TabSeparatedWithNamesAndTypesFormatter()
         self.rowindex = -1
+        self.rowiterator = None
         self.cache = FilterableCache()
+        self.schemacache = {}
 
     @staticmethod
     def _escapeparameter(param):
+        escape = _ESCAPERS.get(type(param))
+        if escape is not None:
+            return escape(param)
+        # subclasses of the types above, and long on python 2
         if isinstance(param, bool):
-            return '1' if param else '0'
+            return _ESCAPERS[bool](param)
         if isinstance(param, int) or isinstance(param, float):
-            return param
+            return str(param)
         if isinstance(param, dt.datetime):
-            return "'%s'" % (str(param.replace(microsecond=0)))
-        return "'%s'" % (str(param).replace("'", "\\'"))
+            return _escapedatetime(param)
+        return _escapestring(param)
+
+    @staticmethod
+    def _substituteparameters(query, args):
+        if args is not None and len(args) > 0:
+            query = query % tuple([Cursor._escapeparameter(x) for x in args])
+        return query
 
     def execute(self, query, *args):
         """
@@ -68,8 +158,9 @@ class Cursor(object):
         """
         Execute a select query.
 
-        You can only use FORMAT TabSeparatedWithNamesAndTypes in your query, or omit it, in
-    which case it will be added to the query automatically.
+        You can only use the FORMAT of the Cursor's "formatter" in your query (TabSeparatedWithNamesAndTypes by
+    default, or RowBinaryWithNamesAndTypes, which returns DateTime values in UTC), or omit it, in which case it will
+    be added to the query automatically.
 
     After calling "select", you can call "fetchone" or "fetchall" to retrieve results, which will come in form
     of dictionaries.
@@ -77,17 +168,57 @@ class Cursor(object):
     You can pass parameters to the queries, by marking their places in the query using %s, for example
     cursor.select('SELECT count() FROM table WHERE field=%s', 123)
         """
-        if re.match(r'^.+?\s+format\s+\w+$', query.lower()) is None:
-            query += ' FORMAT TabSeparatedWithNamesAndTypes'
-            self.executewithpayload(query, None, True, *args)
+        if _FORMAT_RE.search(query) is None:
+            query += ' FORMAT ' + self.formatter.output_format
+            if self.resultcachesize > 0:
+                self._cachedselect(query, args)
+            else:
+                self.executewithpayload(query, None, True, *args)
         else:
             self.executewithpayload(query, None, False, *args)
 
+    def _cachedselect(self, query, args):
+        # the key is the final query, as parameters comparing equal (like 1 and Decimal('1')) can escape differently
+        query = Cursor._substituteparameters(query, args)
+        result = self.resultcache.pop(query, None)
+        if result is None:
+            self.executewithpayload(query, None, True)
+            result = self.lastparsedresult
+            if len(self.resultcache) >= self.resultcachesize:
+                self.resultcache.popitem(last=False)
+        else:
+            if self.lastresult is not None:
+                self.lastresult.close()
+            self.lastresult = None
+            self.rowiterator = None
+            self.rowindex = -1
+        self.resultcache[query] = result
+        self.lastparsedresult = [dict(row) for row in result]  # callers may change the rows, the cache must not change
+
+    def clear_result_cache(self):
+        """
+        Forget all select results cached by this Cursor.
+        """
+        self.resultcache.clear()
+
+    def select_stream(self, query, *args):
+        """
+        Execute a select query like "select" does, but without downloading and parsing the whole result at once.
+        The rows are parsed one by one while they are being retrieved with "fetchone", so that the memory consumption
+        doesn't depend on the size of the result. Calling "fetchall" parses all remaining rows.
+        """
+        if _FORMAT_RE.search(query) is None:
+            query += ' FORMAT ' + self.formatter.output_format
+            self._execute(query, None, True, True, args)
+        else:
+            self._execute(query, None, False, False, args)
+
     def insert(self, query, *args):
         """
         Execute an insert query with data packed inside of the query parameter. Note that using "bulkinsert" can
         be more comfortable if your data is a list of dict or list of objects.
         """
+        self.clear_result_cache()
         self.executewithpayload(query, None, False, *args)
 
     def ddl(self, query, *args):
@@ -95,6 +226,8 @@ class Cursor(object):
         Execute a DDL statement or other query, which doesn't return a result. Note that this statement will be
         commited automatically if succcessful.
         """
+        self.clear_result_cache()
+        self.schemacache.clear()
         self.executewithpayload(query, None, False, *args)
 
     def bulkinsert(self, table, values, fields=None, types=None):
@@ -109,26 +242,33 @@ class Cursor(object):
         objects passed in the values parameter. If some dictionary doesn't have that key, a None value will be assumed
         :param types: optional list of strings representing Clickhouse types of corresponding fields, to ensure proper
         escaping. If omitted, the types will be inferred automatically from the first element of the values list.
+
+        The values are formatted while they are being sent. If a value cannot be formatted, the rows before it have
+        already been sent and the request is aborted. Clickhouse may already have written some of these rows (at least
+        when there are more than max_insert_block_size of them), so a formatting error can leave a partial insert.
         """
-        fields, types, payload = self.formatter.format(values, fields, types)
-        if len(payload) < 2000000000:
-            self.executewithpayload('INSERT INTO %s (%s) FORMAT TabSeparatedWithNamesAndTypes' %
-                                    (table, ','.join(fields)), payload, False)
-        else:
-            batch = int(2000000000.0/len(payload)*len(values))
-            if batch < 1:
-                raise Exception("Payload of the values is larger than 2Gb, Clickhouse won't probably accept that")
-            for i in range(0, len(values), batch):
-                self.bulkinsert(table, values[i:i+batch], fields, types)
+        self.clear_result_cache()
+        fields, types = self.formatter.resolve_schema(values, fields, types)
+        # the payload is generated and sent in chunks, so that its size is not limited by the available memory
+        self.executewithpayload('INSERT INTO %s (%s) FORMAT TabSeparatedWithNamesAndTypes' %
+                                (table, ','.join(fields)), self.formatter.iter_format(values, fields, types), False)
 
     def executewithpayload(self, query, payload, parseresult, *args):
         """
         Private method.
         """
-        if args is not None and len(args) > 0:
-            query = query % tuple([Cursor._escapeparameter(x) for x in args])
-        self.lastresult = self.connection._call(query, payload)
-        if parseresult and self.lastresult is not None:
+        self._execute(query, payload, parseresult, False, args)
+
+    def _execute(self, query, payload, parseresult, stream, args):
+        if self.lastresult is not None:
+            self.lastresult.close()  # release the TCP connection of a not completely consumed stream
+        self.rowiterator = None
+        query = Cursor._substituteparameters(query, args)
+        self.lastresult = self.connection._call(query, payload, stream)
+        if parseresult and stream and self.lastresult is not None:
+            self.rowiterator = self.formatter.iter_unformat(self.lastresult.iter_content(chunk_size=65536))
+            self.lastparsedresult = None
+        elif parseresult and self.lastresult is not None:
             self.lastparsedresult = self.formatter.unformat(self.lastresult.content)
             self.lastresult = None # hint GC to free memory
         else:
@@ -139,6 +279,8 @@ class Cursor(object):
         """
         Fetch one next result row after a select query and return it as a dictionary, or None if there is no more rows.
         """
+        if self.rowiterator is not None:
+            return next(self.rowiterator, None)
         if self.lastparsedresult is None:
             return self.lastresult.content
         if self.rowindex >= len(self.lastparsedresult)-1:
@@ -150,6 +292,8 @@ class Cursor(object):
         """
         Fetch all resulting rows of a select query as a list of dictionaries.
         """
+        if self.rowiterator is not None:
+            return list(self.rowiterator)
         return self.lastparsedresult
 
     def cached_select(self, query, filter):
@@ -176,6 +320,14 @@ class Cursor(object):
         return self.cache.select(tag, filter)
 
     def get_schema(self, table):
+        """
+        Return a tuple of the list of column names and the list of their types of the table. The schema is cached
+        until the next "ddl" call of this Cursor.
+        """
+        if table in self.schemacache:
+            names, types = self.schemacache[table]
+            return list(names), list(types)
+        key = table
         table = table.split('.')
         if len(table) > 2:
             raise Exception('%s is an invalid table name' % table)
@@ -187,7 +339,11 @@ class Cursor(object):
             tablename = table[0]
 
         self.select('select name, type from system.columns where database=%s and table=%s', database, tablename)
-        return  ([x['name'] for x in self.fetchall()], [x['type'] for x in self.fetchall()])
+        rows = self.fetchall()
+        names, types = [x['name'] for x in rows], [x['type'] for x in rows]
+        if len(rows) > 0:  # don't cache missing tables, they might be created by someone else
+            self.schemacache[key] = (names, types)
+        return list(names), list(types)
 
     @staticmethod
     def _flatten_array(arr, prefix='', path=[]):
@@ -195,26 +351,43 @@ class Cursor(object):
         mapping = {}
 
         try:
+            # first pass: flatten the elements and collect the union of the resulting keys
+            elements = []
+            keys = OrderedDict()
             for i, element in enumerate(arr):
-                if element is None or (hasattr(element, '__len__') and len(element) == 0):
+                if element is None:
                     continue
-                if hasattr(element, 'items'):
+                if isinstance(element, Mapping):
+                    if len(element) == 0:
+                        continue
                     r, m = Cursor._flatten_dict(element, prefix, path, allow_arrays=False)
-                    for k, v in r.items():
-                        if k not in result:
-                            result[k] = [None] * len(arr)
-                        result[k][i] = v
                     mapping.update(m)
-                elif hasattr(element, '__iter__') and not isinstance(element, str):
+                elif isinstance(element, _ARRAY_TYPES):
+                    if len(element) == 0:
+                        continue
+                    raise NestingLevelTooHigh()
+                elif _isotheriterable(element):
                     raise NestingLevelTooHigh()
                 else:
-                    if prefix not in result:
-                        result[prefix] = [None]*len(arr)
-                    result[prefix][i] = element
-                    mapping[prefix] = '&'.join(['%s=%s' % x for x in path])
+                    if isinstance(element, _STRING_TYPES) and len(element) == 0:
+                        continue
+                    r = {prefix: element}
+                    if prefix not in mapping:
+                        mapping[prefix] = '&'.join(['%s=%s' % x for x in path])
+                elements.append((i, r))
+                for k in r:
+                    keys[k] = True
+
+            # second pass: fill the columns, each allocated only once
+            size = len(arr)
+            for k in keys:
+                result[k] = [None] * size
+            for i, r in elements:
+                for k, v in r.items():
+                    result[k][i] = v
         except NestingLevelTooHigh:
-            result[prefix+'_json'] = ujson.dumps(arr)
-            mapping[prefix+'_json'] = '&'.join(['%s=%s' % x for x in path[:-1]+[(path[-1][0], 'json')]])
+            result = {prefix+'_json': _tojson(arr)}
+            mapping = {prefix+'_json': '&'.join(['%s=%s' % x for x in path[:-1]+[(path[-1][0], 'json')]])}
 
         return result, mapping
 
@@ -227,13 +400,19 @@ class Cursor(object):
             prefix += '_'
 
         for k,v in doc.items():
-            if v is None or (hasattr(v, '__len__') and len(v) == 0):
+            if v is None:
                 continue
-            if hasattr(v, 'items'):
+            if not isinstance(v, Mapping) and not isinstance(v, _ARRAY_TYPES) and _isotheriterable(v):
+                v = list(v)  # e.g. a generator, which could be consumed only once
+            if isinstance(v, Mapping):
+                if len(v) == 0:
+                    continue
                 r, m = Cursor._flatten_dict(v, prefix + k, path + [(k, 'dict')])
                 result.update(r)
                 mapping.update(m)
-            elif hasattr(v, '__iter__') and not isinstance(v, str):
+            elif isinstance(v, _ARRAY_TYPES):
+                if len(v) == 0:
+                    continue
                 if allow_arrays:
                     r, m = Cursor._flatten_array(v, prefix + k, path + [(k, 'array')])
                     result.update(r)
@@ -241,6 +420,8 @@ class Cursor(object):
                 else:
                     raise NestingLevelTooHigh()
             else:
+                if isinstance(v, _STRING_TYPES) and len(v) == 0:
+                    continue
                 result[prefix+k] = v
                 mapping[prefix+k] = '&'.join(['%s=%s' % x for x in path+[(k,'scalar')]])
 
@@ -280,9 +461,28 @@ class Cursor(object):
 
                 return fields, new_types
             except Exception as e:
+                if not _isconcurrentschemachange(e):
+                    raise
+                self.schemacache.pop(table, None)  # the table has been changed by someone else meanwhile
+                error = e
                 tries += 1
+                if tries < 5:
+                    time.sleep(2 ** (tries - 1) * 0.05)
+
+        raise Exception('Cannot ensure target schema in %s, %s' % (table, error))
 
-        raise Exception('Cannot ensure target schema in %s, %s' % (table, e.message))
+    def batch_context(self, table, nullablelambda=lambda fieldname: False, max_rows=65536):
+        """
+        Return a context manager collecting documents passed to its "store_documents" method, which are stored into
+        the table using a single "store_documents" call of this Cursor when the context is left without exception, or
+        whenever max_rows documents are collected. This amortizes the schema inference and the insert overhead when
+        documents come in many small lists, for example:
+
+            with cursor.batch_context('docs') as batch:
+                for documents in source:
+                    batch.store_documents(documents)
+        """
+        return DocumentBatch(self, table, nullablelambda, max_rows)
 
     def store_documents(self, table, documents, nullablelambda=lambda fieldname: False):
         """Store dictionaries or objects into table, extending the table schema if needed. If the type of some value in
@@ -295,10 +495,16 @@ class Cursor(object):
                 self.bulkinsert(table, flattened, fields, types)
                 return
             except Exception as e:
-                if 'bad version' in e.message:  # can happen if we're inserting data while some other process is changing the table
+                # the table might have been changed or recreated by someone else, so the next store_documents call
+                # has to read its schema again
+                self.schemacache.pop(table, None)
+                if 'bad version' in str(e):  # can happen if we're inserting data while some other process is changing the table
                     tries += 1
+                    if tries < 5:
+                        time.sleep(2 ** (tries - 1) * 0.05)
                 else:
                     raise
+        raise Exception('Cannot store documents in %s, the table is being changed concurrently' % table)
 
         def store_only_changed_documents(self, table, documents, primary_keys, datetimefield, ignore_fields=None,
                                          where='1=1', nullablelambda=lambda fieldname: False):
@@ -366,20 +572,16 @@ class Cursor(object):
     def prepare_document_table(self, table, documents, nullablelambda=lambda fieldname: False):
         flattened = []
         commentmap = {}
+        columns = OrderedDict()  # the same values as in flattened, but organized by field to infer the schema at once
         for doc in documents:
             f, m = Cursor._flatten_dict(doc)
             commentmap.update(m)
             flattened.append(f)
-        doc_schema = {}
-        for doc in flattened:
-            doc_fields, doc_types = self.formatter.get_schema(doc, nullablelambda)
-            for f, t in zip(doc_fields, doc_types):
-                if f not in doc_schema:
-                    doc_schema[f] = t
-                elif doc_schema[f] != t:
-                    doc_schema[f] = self.formatter.generalize_type(doc_schema[f], t)
-        fields = doc_schema.keys()
-        types = [doc_schema[f] for f in fields]
+            for k, v in f.items():
+                if k not in columns:
+                    columns[k] = []
+                columns[k].append(v)
+        fields, types = self.formatter.get_schema_from_columns(columns, nullablelambda)
         fields, types = self._ensure_schema(table, fields, types, commentmap)
         return fields, flattened, types
 
@@ -443,3 +645,39 @@ class Cursor(object):
             mapping[map['name']] = map['_comment']
 
         return [Cursor._unflatten_dict(row, mapping) for row in rows]
+
+
+class DocumentBatch(object):
+    """
+    Collects documents to be stored into a table by Cursor.store_documents, see Cursor.batch_context.
+    """
+    def __init__(self, cursor, table, nullablelambda=lambda fieldname: False, max_rows=65536):
+        self.cursor = cursor
+        self.table = table
+        self.nullablelambda = nullablelambda
+        self.max_rows = max_rows
+        self.pending = []
+
+    def store_documents(self, documents):
+        """
+        Add the documents to the batch, storing the batch if it has reached max_rows documents.
+        """
+        self.pending.extend(documents)
+        if len(self.pending) >= self.max_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        Store all collected documents now.
+        """
+        if len(self.pending) > 0:
+            documents = self.pending
+            self.pending = []
+            self.cursor.store_documents(self.table, documents, self.nullablelambda)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
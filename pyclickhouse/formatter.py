@@ -2,6 +2,9 @@ from __future__ import print_function, absolute_import
 import ujson
 
 import sys
+import socket
+import struct
+import uuid
 import datetime as dt
 from decimal import Decimal
 
@@ -71,6 +74,11 @@ class ObjectAdapter(object):
         return getattr(obj, field)
 
 class TabSeparatedWithNamesAndTypesFormatter(object):
+    output_format = 'TabSeparatedWithNamesAndTypes'
+
+    def __init__(self):
+        self.unformatters = {}
+
     def generalize_type(self, existing_type, new_type):
         arr = 'Array('
         nu = 'Nullable('
@@ -117,7 +125,7 @@ class TabSeparatedWithNamesAndTypesFormatter(object):
             islong = isinstance(pythonobj, int)
         if isstring:
             result = 'String'
-        elif isinstance(pythonobj, str):
+        elif isinstance(pythonobj, str) or isinstance(pythonobj, bytes):
             result = 'String'
         elif isinstance(pythonobj, bool):
             result = 'UInt8'
@@ -164,7 +172,39 @@ class TabSeparatedWithNamesAndTypesFormatter(object):
 
         return fields, types
 
-    def format(self, rows, fields=None, types=None):
+    def get_schema_from_columns(self, columns, nullablelambda=lambda fieldname: False):
+        """
+        Infer the schema of column-oriented data, passed as a dictionary of field names to lists of values. The result
+        is the same as calling get_schema for every row and generalizing the types of every field, but the type of
+        scalar values is inferred only once per python type and field.
+        """
+        fields = list(columns.keys())
+        types = []
+        for field in fields:
+            scalartypes = {}
+            fieldtype = None
+            for value in columns[field]:
+                if value is None:
+                    continue
+                pythontype = type(value)
+                if pythontype in scalartypes:
+                    continue
+                t = self.clickhousetypefrompython(value, field, nullablelambda)
+                if not t.startswith('Array(') and not t.startswith('Nullable(Array('):
+                    scalartypes[pythontype] = t
+                if fieldtype is None:
+                    fieldtype = t
+                elif fieldtype != t:
+                    fieldtype = self.generalize_type(fieldtype, t)
+            if fieldtype is None:
+                raise Exception('Cannot infer type of "%s" from None' % field)
+            types.append(fieldtype)
+        return fields, types
+
+    def resolve_schema(self, rows, fields=None, types=None):
+        """
+        Return fields and types to format the rows with, inferring them from the first row if they are not passed.
+        """
         if len(rows) == 0:
             raise Exception('No data in rows')
 
@@ -174,16 +214,46 @@ class TabSeparatedWithNamesAndTypesFormatter(object):
         if sys.version_info[0] == 2:
             fields = [x.encode('utf8') for x in fields]
 
+        return fields, types
+
+    def iter_format(self, rows, fields, types, chunk_bytes=1024*1024):
+        """
+        Same as format, but yields the payload as utf8 encoded chunks of about chunk_bytes size, so that the whole
+        payload never has to be kept in memory. The fields and types must be already resolved, see resolve_schema.
+        """
         if isinstance(rows[0], dict):
             adapter = DictionaryAdapter()
         else:
             adapter = ObjectAdapter()
 
-        return fields, types, '%s\n%s\n%s' % (
+        lines = ['\t'.join(fields), '\t'.join(types)]
+        size = 0
+        for r in rows:
+            line = '\t'.join([self.formatfield(adapter.getval(r, f), t, f) for f, t in zip(fields, types)])
+            lines.append(line)
+            size += len(line)
+            if size >= chunk_bytes:
+                lines.append('')
+                yield '\n'.join(lines).encode('utf8')
+                lines = []
+                size = 0
+        if len(lines) > 0:
+            lines.append('')
+            yield '\n'.join(lines).encode('utf8')
+
+    def format(self, rows, fields=None, types=None):
+        fields, types = self.resolve_schema(rows, fields, types)
+
+        if isinstance(rows[0], dict):
+            adapter = DictionaryAdapter()
+        else:
+            adapter = ObjectAdapter()
+
+        return fields, types, ('%s\n%s\n%s' % (
             '\t'.join(fields),
             '\t'.join(types),
             '\n'.join(['\t'.join([self.formatfield(adapter.getval(r, f), t, f) for f, t in zip(fields, types)]) for r in rows])
-        )
+        )).encode('utf8')
 
     def formatfield(self, value, type, name, inarray = False):
         try:
@@ -326,6 +396,43 @@ class TabSeparatedWithNamesAndTypesFormatter(object):
         raise Exception('Unexpected error, field cannot be unformatted, %s, %s' % (str(value), type))
 
 
+    def getunformatter(self, type):
+        """
+        Return a function converting a single TSV value of the Clickhouse type to python, equivalent to unformatfield.
+        The type is resolved only once and the function is cached, so that parsing a result doesn't have to inspect
+        the type string again for every field.
+        """
+        if type not in self.unformatters:
+            self.unformatters[type] = self._buildunformatter(type)
+        return self.unformatters[type]
+
+    def _buildunformatter(self, type):
+        if type.startswith('LowCardinality(') and type.endswith(')'):
+            return self._buildunformatter(type[len('LowCardinality('):-1])
+
+        if type.startswith('Nullable(') and type.endswith(')'):
+            inner = self._buildunformatter(type[len('Nullable('):-1])
+            return lambda value: None if value == '\\N' else inner(value)
+
+        if type in ['UInt8','UInt16', 'UInt32', 'UInt64','Int8','Int16','Int32','Int64']:
+            return int
+        if type in ['String', 'IPv6', 'UUID']:
+            return lambda value: value.replace('\\n','\n').replace('\\t','\t').replace('\\\\','\\')
+        if type in ['Float32', 'Float64']:
+            return float
+        # Dates and arrays are rare enough to be handled by the generic code, which also raises for unknown types
+        return lambda value: self.unformatfield(value, type)
+
+    def _unformatlines(self, lines, fields, types):
+        converters = [self.getunformatter(t) for t in types]
+        for line in lines:
+            yield dict(zip(fields, [c(v) for c, v in zip(converters, line.split('\t'))]))
+
+    def _decodeline(self, line_b):
+        if sys.version_info[0] == 3:
+            return line_b.decode('utf8')
+        return line_b
+
     def unformat(self, payload_b):
         if sys.version_info[0] == 3:
             payload = payload_b.decode('utf8')
@@ -337,16 +444,235 @@ class TabSeparatedWithNamesAndTypesFormatter(object):
 
         fields = payload[0].split('\t')
         types = payload[1].split('\t')
-        result = []
-        for line in payload[2:-1]:
-            line = line.split('\t')
-            d = dict()
-            for l, t, f in zip(line, types, fields):
-                d[f] = self.unformatfield(l,t)
-            result.append(d)
+        return list(self._unformatlines(payload[2:-1], fields, types))
+
+    def iter_unformat(self, chunks):
+        """
+        Same as unformat, but parses the payload coming as an iterable of bytes chunks (for example from
+        Response.iter_content) lazily, yielding one dictionary per row.
+        """
+        fields = None
+        types = None
+        rest = b''
+        for chunk in chunks:
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            if types is None:
+                while types is None and len(lines) > 0:
+                    header = self._decodeline(lines.pop(0)).split('\t')
+                    if fields is None:
+                        fields = header
+                    else:
+                        types = header
+            if types is not None:
+                for row in self._unformatlines([self._decodeline(x) for x in lines], fields, types):
+                    yield row
+        if types is None:
+            raise Exception('Unexpected error, no result')
+
+
+_FIXED_WIDTH_TYPES = {
+    'UInt8': 'B', 'UInt16': 'H', 'UInt32': 'I', 'UInt64': 'Q',
+    'Int8': 'b', 'Int16': 'h', 'Int32': 'i', 'Int64': 'q',
+    'Float32': 'f', 'Float64': 'd',
+}
+_EPOCH_DATE = dt.date(1970, 1, 1)
+_EPOCH_DATETIME = dt.datetime(1970, 1, 1)
+
+
+def _readvarint(buf, offset):
+    b = buf[offset]
+    if b < 0x80:
+        return b, offset + 1
+    result = b & 0x7f
+    shift = 7
+    while True:
+        offset += 1
+        b = buf[offset]
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, offset + 1
+        shift += 7
+
+
+def _readstring(buf, offset):
+    length, offset = _readvarint(buf, offset)
+    end = offset + length
+    if end > len(buf):
+        raise IndexError('String exceeds the buffer')
+    return buf[offset:end].decode('utf8'), end
+
+
+class RowBinaryWithNamesAndTypesFormatter(TabSeparatedWithNamesAndTypesFormatter):
+    """
+    Reads select results in the binary RowBinaryWithNamesAndTypes format, which is considerably faster to parse than
+    TabSeparatedWithNamesAndTypes, because numbers don't have to be converted from text and strings don't have to be
+    unescaped. Set it as "formatter" of a Cursor to use it for "select" and "select_stream". Inserts are still made
+    using TabSeparatedWithNamesAndTypes.
+
+    Unlike with the TSV formatter, DateTime values are returned as naive datetimes in UTC (and not in the time zone of
+    the server), and Float32 values are not rounded to their shortest decimal representation.
+    """
+    output_format = 'RowBinaryWithNamesAndTypes'
+
+    def __init__(self):
+        super(RowBinaryWithNamesAndTypesFormatter, self).__init__()
+        self.readers = {}
+
+    def getreader(self, type):
+        """
+        Return a function reading a value of the Clickhouse type from a buffer at an offset, returning the value and
+        the offset after it.
+        """
+        if type not in self.readers:
+            self.readers[type] = self._buildreader(type)
+        return self.readers[type]
+
+    def _buildreader(self, type):
+        if type.startswith('LowCardinality(') and type.endswith(')'):
+            return self._buildreader(type[len('LowCardinality('):-1])
+
+        if type.startswith('Nullable(') and type.endswith(')'):
+            inner = self._buildreader(type[len('Nullable('):-1])
+
+            def readnullable(buf, offset):
+                if buf[offset] == 1:
+                    return None, offset + 1
+                return inner(buf, offset + 1)
+            return readnullable
+
+        if type.startswith('Array(') and type.endswith(')'):
+            inner = self._buildreader(type[len('Array('):-1])
 
+            def readarray(buf, offset):
+                length, offset = _readvarint(buf, offset)
+                result = []
+                for _ in range(length):
+                    value, offset = inner(buf, offset)
+                    result.append(value)
+                return result, offset
+            return readarray
+
+        if type in _FIXED_WIDTH_TYPES:
+            fmt = struct.Struct('<' + _FIXED_WIDTH_TYPES[type])
+            return lambda buf, offset: (fmt.unpack_from(buf, offset)[0], offset + fmt.size)
+
+        if type == 'String':
+            return _readstring
+
+        if type == 'Nothing':
+            # only occurs as Nullable(Nothing) of NULL and Array(Nothing) of [], so there is never a value to read
+            return lambda buf, offset: (None, offset)
+
+        if type == 'Date':
+            fmt = struct.Struct('<H')
+
+            def readdate(buf, offset):
+                days = fmt.unpack_from(buf, offset)[0]
+                return (_EPOCH_DATE + dt.timedelta(days=days)) if days > 0 else None, offset + 2
+            return readdate
+
+        if type == 'DateTime':
+            fmt = struct.Struct('<I')
+
+            def readdatetime(buf, offset):
+                seconds = fmt.unpack_from(buf, offset)[0]
+                return (_EPOCH_DATETIME + dt.timedelta(seconds=seconds)) if seconds > 0 else None, offset + 4
+            return readdatetime
+
+        if type == 'UUID':
+            fmt = struct.Struct('<QQ')
+
+            def readuuid(buf, offset):
+                high, low = fmt.unpack_from(buf, offset)
+                return str(uuid.UUID(int=(high << 64) | low)), offset + 16
+            return readuuid
+
+        if type == 'IPv6':
+            def readipv6(buf, offset):
+                if offset + 16 > len(buf):
+                    raise IndexError('IPv6 exceeds the buffer')
+                return socket.inet_ntop(socket.AF_INET6, bytes(buf[offset:offset + 16])), offset + 16
+            return readipv6
+
+        raise Exception('Unexpected error, type %s is not supported in RowBinary format' % type)
+
+    def _buildrowreader(self, types):
+        """
+        Return a function reading a whole row as a list of values. Consecutive columns of fixed width numeric types
+        are read at once using a single precompiled struct.
+        """
+        segments = []
+        run = ''
+        for t in types:
+            if t in _FIXED_WIDTH_TYPES:
+                run += _FIXED_WIDTH_TYPES[t]
+                continue
+            if len(run) > 0:
+                segments.append((struct.Struct('<' + run), None))
+                run = ''
+            segments.append((None, self.getreader(t)))
+        if len(run) > 0:
+            segments.append((struct.Struct('<' + run), None))
+
+        def readrow(buf, offset):
+            row = []
+            for fmt, reader in segments:
+                if fmt is not None:
+                    row.extend(fmt.unpack_from(buf, offset))
+                    offset += fmt.size
+                else:
+                    value, offset = reader(buf, offset)
+                    row.append(value)
+            return row, offset
+        return readrow
+
+    def _readheader(self, buf):
+        count, offset = _readvarint(buf, 0)
+        header = []
+        for _ in range(2 * count):
+            value, offset = _readstring(buf, offset)
+            header.append(value)
+        return header[:count], header[count:], offset
+
+    def unformat(self, payload_b):
+        buf = bytearray(payload_b) if sys.version_info[0] == 2 else payload_b
+        try:
+            fields, types, offset = self._readheader(buf)
+            if all([t in _FIXED_WIDTH_TYPES for t in types]) and hasattr(struct, 'iter_unpack'):
+                # all rows have the same size, so they can be unpacked in one go
+                fmt = struct.Struct('<' + ''.join([_FIXED_WIDTH_TYPES[t] for t in types]))
+                return [dict(zip(fields, row)) for row in fmt.iter_unpack(memoryview(buf)[offset:])]
+            readrow = self._buildrowreader(types)
+            result = []
+            while offset < len(buf):
+                row, offset = readrow(buf, offset)
+                result.append(dict(zip(fields, row)))
+        except (IndexError, struct.error):
+            raise Exception('Unexpected error, RowBinary result is truncated')
         return result
 
+    def iter_unformat(self, chunks):
+        fields = None
+        readrow = None
+        buf = b''
+        for chunk in chunks:
+            buf = buf + (bytearray(chunk) if sys.version_info[0] == 2 else chunk)
+            offset = 0
+            try:
+                if readrow is None:
+                    fields, types, offset = self._readheader(buf)
+                    readrow = self._buildrowreader(types)
+                while offset < len(buf):
+                    row, end = readrow(buf, offset)
+                    offset = end
+                    yield dict(zip(fields, row))
+            except (IndexError, struct.error):  # the rest of the row will come with the next chunk
+                pass
+            buf = buf[offset:]
+        if readrow is None or len(buf) > 0:
+            raise Exception('Unexpected error, RowBinary result is truncated')
+
 
 # Testing
 if __name__ == '__main__':
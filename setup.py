@@ -14,6 +14,7 @@ setup(name='pyclickhouse',
       license='Apache2',
       packages=['pyclickhouse'],
       install_requires=REQUIRED,
+      extras_require={'orjson': ['orjson']},
       use_2to3=True,
       test_suite='test',
       zip_safe=False)
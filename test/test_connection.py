@@ -0,0 +1,26 @@
+# coding=utf-8
+import unittest
+
+from pyclickhouse import Connection
+
+
+class TestConnection(unittest.TestCase):
+    """Tests of the Connection that don't need a running Clickhouse"""
+
+    def test_basic_auth_header(self):
+        conn = Connection('h', username='u', password='p')
+        assert conn._headers['Authorization'] == 'Basic dTpw'
+
+    def test_reopensession_keeps_sharing(self):
+        conn = Connection('h', pool_maxsize=3)
+        conn2 = Connection('h', pool_maxsize=3)
+        assert conn.session is conn2.session
+        adapters = conn.session.adapters
+        adapter = conn.session.get_adapter('http://h')
+        conn.reopensession()
+        assert conn.session is conn2.session
+        assert conn2.session.get_adapter('http://h') is not adapter
+        # the mapping a concurrent request may be iterating is replaced, not changed
+        assert conn.session.adapters is not adapters and adapters['http://'] is adapter
+        assert list(conn.session.adapters) == ['https://', 'http://']
+        assert Connection('h', pool_maxsize=4).session is not conn.session
@@ -0,0 +1,154 @@
+# coding=utf-8
+import unittest
+import time
+import datetime as dt
+from decimal import Decimal
+import ujson
+
+from pyclickhouse import Cursor
+from pyclickhouse.Cursor import _tojson, orjson, DocumentBatch
+
+
+class StubResponse(object):
+    def __init__(self, content):
+        self.content = content
+        self.ok = True
+
+    def iter_content(self, chunk_size=1):
+        return iter([self.content])
+
+    def close(self):
+        pass
+
+
+class StubConnection(object):
+    """Records the queries and answers every query with the same result"""
+    def __init__(self):
+        self.queries = []
+
+    def _call(self, query=None, payload=None, stream=False):
+        self.queries.append(query)
+        if payload is not None:
+            b''.join(payload)
+        return StubResponse(b'id\tname\nUInt64\tString\n1\ta\n2\tb\n')
+
+
+class TestCursor(unittest.TestCase):
+    """Tests of the Cursor that don't need a running Clickhouse"""
+
+    def setUp(self):
+        self.conn = StubConnection()
+        self.cursor = Cursor(self.conn, result_cache_size=2)
+
+    def test_result_cache(self):
+        self.cursor.select('select * from t where id=%s', 1)
+        first = self.cursor.fetchall()
+        first[0]['name'] = 'changed'
+        self.cursor.select('select * from t where id=%s', 1)
+        assert self.cursor.fetchall() == [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+        assert len(self.conn.queries) == 1
+
+        self.cursor.select('select * from t where id=%s', 2)
+        assert len(self.conn.queries) == 2
+
+    def test_result_cache_is_keyed_by_escaped_query(self):
+        # equal parameters escaping to different SQL must not share a cache entry
+        for param in [1, 1.0, Decimal('1')]:
+            self.cursor.select('select * from t where id=%s', param)
+        assert len(self.conn.queries) == 3
+        assert self.conn.queries[2] == "select * from t where id='1' FORMAT TabSeparatedWithNamesAndTypes"
+
+        # unhashable parameters are cached too
+        self.cursor.select('select * from t where id in %s', [1, 2])
+        self.cursor.select('select * from t where id in %s', [1, 2])
+        assert len(self.conn.queries) == 4
+
+    def test_result_cache_is_cleared_by_writes(self):
+        writes = [lambda: self.cursor.ddl('optimize table t'),
+                  lambda: self.cursor.insert("insert into t values (3, 'c')"),
+                  lambda: self.cursor.bulkinsert('t', [{'id': 3, 'name': 'c'}])]
+        for write in writes:
+            self.cursor.select('select * from t')
+            assert len(self.cursor.resultcache) == 1
+            write()
+            assert len(self.cursor.resultcache) == 0
+            queries = len(self.conn.queries)
+            self.cursor.select('select * from t')
+            assert len(self.conn.queries) == queries + 1
+
+    def test_schema_cache_is_dropped_on_failed_store(self):
+        cursor = Cursor(self.conn)
+        cursor.schemacache['t'] = (['id'], ['UInt64'])
+
+        def failing_bulkinsert(*args):
+            raise Exception('Table t does not exist')
+        cursor.bulkinsert = failing_bulkinsert
+        self.assertRaises(Exception, cursor.store_documents, 't', [{'id': 1}])
+        assert 't' not in cursor.schemacache
+
+    def test_json_serialization(self):
+        value = [{'u': u'a/b', 'v': None, 1: u'föö'}, 1e20, float('nan')]
+        if orjson is None:
+            assert _tojson(value) == ujson.dumps(value)
+        else:
+            # the style doesn't depend on the content, e.g. on whether null is in it
+            assert _tojson(value) == u'[{"u":"a/b","v":null,"1":"föö"},1e20,null]'
+            assert _tojson([u'a/b']) == u'["a/b"]'
+        assert ujson.loads(_tojson([2 ** 70])) == [2 ** 70]
+        self.assertRaises(TypeError, _tojson, [dt.datetime(2019, 6, 7)])
+
+    def test_no_backoff_after_last_attempt(self):
+        cursor = Cursor(self.conn)
+        cursor.prepare_document_table = lambda table, documents, nullablelambda: (['id'], documents, ['UInt64'])
+        sleeps = []
+
+        def failing_bulkinsert(*args):
+            raise Exception('Code: 999, bad version')
+        cursor.bulkinsert = failing_bulkinsert
+        sleep = time.sleep
+        time.sleep = sleeps.append
+        try:
+            self.assertRaises(Exception, cursor.store_documents, 't', [{'id': 1}])
+        finally:
+            time.sleep = sleep
+        assert sleeps == [0.05, 0.1, 0.2, 0.4]
+
+
+class StubDocumentCursor(object):
+    """Records the calls of store_documents instead of storing anything"""
+    def __init__(self):
+        self.stored = []
+
+    def store_documents(self, table, documents, nullablelambda=lambda fieldname: False):
+        self.stored.append((table, list(documents)))
+
+
+class TestDocumentBatch(unittest.TestCase):
+    """Tests of Cursor.batch_context that don't need a running Clickhouse"""
+
+    def setUp(self):
+        self.cursor = StubDocumentCursor()
+
+    def test_flush_at_max_rows(self):
+        batch = DocumentBatch(self.cursor, 't', max_rows=3)
+        batch.store_documents([{'id': 1}, {'id': 2}])
+        assert self.cursor.stored == []
+        batch.store_documents([{'id': 3}])
+        assert self.cursor.stored == [('t', [{'id': 1}, {'id': 2}, {'id': 3}])]
+        assert batch.pending == []
+
+    def test_flush_on_exit(self):
+        with Cursor.batch_context(self.cursor, 't') as batch:
+            batch.store_documents([{'id': 1}])
+            batch.store_documents([{'id': 2}])
+            assert self.cursor.stored == []
+        assert self.cursor.stored == [('t', [{'id': 1}, {'id': 2}])]
+
+    def test_nothing_stored_on_exception(self):
+        try:
+            with Cursor.batch_context(self.cursor, 't') as batch:
+                batch.store_documents([{'id': 1}])
+                raise ValueError('producer failed')
+        except ValueError:
+            pass
+        assert self.cursor.stored == []
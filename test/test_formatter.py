@@ -0,0 +1,101 @@
+# coding=utf-8
+import unittest
+import struct
+import uuid
+import datetime as dt
+
+from pyclickhouse.formatter import TabSeparatedWithNamesAndTypesFormatter, RowBinaryWithNamesAndTypesFormatter
+
+
+class TestFormatter(unittest.TestCase):
+    """Tests of the formatter that don't need a running Clickhouse"""
+
+    def setUp(self):
+        self.formatter = TabSeparatedWithNamesAndTypesFormatter()
+
+    def test_iter_unformat(self):
+        payload = u'id\tname\tday\nUInt64\tString\tDate\n1\tföö\\tbar\t2019-06-07\n2\t\t0000-00-00\n'.encode('utf8')
+        expected = self.formatter.unformat(payload)
+        assert expected == [{'id': 1, 'name': u'föö\tbar', 'day': dt.date(2019, 6, 7)},
+                            {'id': 2, 'name': '', 'day': None}]
+        # chunk boundaries must not matter, even inside of multibyte characters
+        for size in [1, 2, 5, len(payload)]:
+            chunks = [payload[i:i+size] for i in range(0, len(payload), size)]
+            assert list(self.formatter.iter_unformat(chunks)) == expected
+
+    def test_unformatter_matches_unformatfield(self):
+        samples = [('42', 'UInt8'), ('-7', 'Int64'), ('1.5', 'Float64'), ('a\\\\b\\nc', 'String'),
+                   ('\\N', 'Nullable(Int32)'), ('3', 'LowCardinality(Nullable(Int32))'), ('x', 'LowCardinality(String)'),
+                   ('2019-06-07 01:02:03', 'DateTime'), ("['a','b,c']", 'Array(String)')]
+        for value, type in samples:
+            assert self.formatter.getunformatter(type)(value) == self.formatter.unformatfield(value, type)
+
+    def test_get_schema_from_columns(self):
+        columns = {'id': [1, 2, 3], 'price': [1, 2.5, None], 'day': [dt.date(2019, 6, 7), dt.datetime(2019, 6, 7, 1)],
+                   'tags': [['a'], [1]], 'flag': [True, 1]}
+        fields, types = self.formatter.get_schema_from_columns(columns)
+        assert dict(zip(fields, types)) == {'id': 'Int64', 'price': 'Float64', 'day': 'DateTime',
+                                            'tags': 'Array(String)', 'flag': 'String'}
+
+    def test_iter_format(self):
+        rows = [{'id': i, 'name': 'row\t%d' % i} for i in range(100)]
+        fields, types = self.formatter.resolve_schema(rows)
+        _, _, payload = self.formatter.format(rows, fields, types)
+        chunks = list(self.formatter.iter_format(rows, fields, types, chunk_bytes=50))
+        assert len(chunks) > 1
+        assert b''.join(chunks) == payload + b'\n'
+
+
+def _varint(value):
+    result = bytearray()
+    while value >= 0x80:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _string(value):
+    value = value.encode('utf8')
+    return _varint(len(value)) + value
+
+
+class TestRowBinaryFormatter(unittest.TestCase):
+    """Tests of the RowBinaryWithNamesAndTypes parser that don't need a running Clickhouse"""
+
+    def setUp(self):
+        self.formatter = RowBinaryWithNamesAndTypesFormatter()
+        names = ['id', 'price', 'name', 'day', 'time', 'maybe', 'tags', 'uuid']
+        types = ['UInt64', 'Float64', 'String', 'Date', 'DateTime', 'Nullable(Int32)', 'Array(LowCardinality(String))',
+                 'UUID']
+        self.payload = _varint(len(names)) + b''.join(_string(x) for x in names + types)
+        u = uuid.UUID('61f0c404-5cb3-11e7-907b-a6006ad3dba0')
+        for i in range(3):
+            self.payload += struct.pack('<Qd', i, i + 0.5) + _string(u'föö' * i)
+            self.payload += struct.pack('<HI', 18054 if i else 0, 1559869323 if i else 0)
+            self.payload += (b'\x00' + struct.pack('<i', -i)) if i % 2 else b'\x01'
+            self.payload += _varint(i) + b''.join(_string('t%d' % x) for x in range(i))
+            self.payload += struct.pack('<QQ', u.int >> 64, u.int & 0xffffffffffffffff)
+        self.expected = [{'id': i, 'price': i + 0.5, 'name': u'föö' * i,
+                          'day': dt.date(2019, 6, 7) if i else None,
+                          'time': dt.datetime(2019, 6, 7, 1, 2, 3) if i else None,
+                          'maybe': -i if i % 2 else None, 'tags': ['t%d' % x for x in range(i)],
+                          'uuid': str(u)} for i in range(3)]
+
+    def test_unformat(self):
+        assert self.formatter.unformat(self.payload) == self.expected
+
+    def test_iter_unformat(self):
+        for size in [1, 3, 7, len(self.payload)]:
+            chunks = [self.payload[i:i+size] for i in range(0, len(self.payload), size)]
+            assert list(self.formatter.iter_unformat(chunks)) == self.expected
+
+    def test_truncated(self):
+        self.assertRaises(Exception, self.formatter.unformat, self.payload[:-1])
+        self.assertRaises(Exception, list, self.formatter.iter_unformat([self.payload[:-1]]))
+
+    def test_nothing(self):
+        # e.g. the result of "select NULL as x, [] as a"
+        payload = _varint(2) + b''.join(_string(x) for x in ['x', 'a', 'Nullable(Nothing)', 'Array(Nothing)'])
+        payload += b'\x01' + _varint(0)
+        assert self.formatter.unformat(payload) == [{'x': None, 'a': []}]
@@ -88,6 +88,38 @@ class TestNewUnitTests(unittest.TestCase):
         assert sub['needs'] == ['json','too_much_nesting']
         assert map == {'id':'id=scalar', 'sub_json': 'sub=json'}
 
+        doc = {'id': 3, 'gen': (x for x in [1, 2]), 'mapped': filter(None, ['1', '2'])}
+        bulk, map = pyclickhouse.Cursor._flatten_dict(doc)
+        assert bulk == {'id': 3, 'gen': [1, 2], 'mapped': ['1', '2']}
+        assert map == {'id':'id=scalar', 'gen': 'gen=array', 'mapped': 'mapped=array'}
+
+        doc = {'id': 3, 'sub': [{'dict': 'fine'}, {'dict': 'in_array', 'needs': ['json']}]}
+        bulk, map = pyclickhouse.Cursor._flatten_dict(doc)
+        assert sorted(bulk.keys()) == ['id', 'sub_json']
+        assert map == {'id':'id=scalar', 'sub_json': 'sub=json'}
+
+        doc = {'id': 3, 'raw': b'abc'}
+        bulk, map = pyclickhouse.Cursor._flatten_dict(doc)
+        assert bulk == doc
+        assert map == {'id':'id=scalar', 'raw': 'raw=scalar'}
+
+    def test_bytes_are_strings(self):
+        formatter = TabSeparatedWithNamesAndTypesFormatter()
+        assert formatter.clickhousetypefrompython(b'abc', 'raw') == 'String'
+        assert formatter.clickhousetypefrompython([b'abc'], 'raw') == 'Array(String)'
+        fields, types = formatter.get_schema_from_columns({'raw': [b'abc', None]})
+        assert types == ['String']
+        assert formatter.format([{'raw': b'abc'}], fields, types)[2] == b'raw\nString\nabc'
+
+    def test_parameter_escaping(self):
+        escape = pyclickhouse.Cursor._escapeparameter
+        assert escape(True) == '1'
+        assert escape(42) == '42'
+        assert escape(0.5) == '0.5'
+        assert escape(dt.datetime(2019, 6, 7, 1, 2, 3, 4)) == "'2019-06-07 01:02:03'"
+        assert escape(dt.date(2019, 6, 7)) == "'2019-06-07'"
+        assert escape("it's") == "'it\\'s'"
+        assert escape("ends with \\") == "'ends with \\\\'"
 
     def test_dict_unflattening(self):
         doc = {'id': 3}